@@ -2041,6 +2041,8 @@ class Parser(multiprocessing.Process):
         bb.utils.set_process_name(multiprocessing.current_process().name)
         multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, exitpriority=1)
         multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, exitpriority=1)
+        if hasattr(bb.parse, "metrics") and bb.parse.metrics.ENABLED:
+            multiprocessing.util.Finalize(None, bb.parse.metrics.flush, args=("exit", True), exitpriority=1)
 
         pending = []
         havejobs = True
@@ -265,6 +265,8 @@ class CookerDataBuilder(object):
 
     def parseBaseConfiguration(self, worker=False):
         mcdata = {}
+        # TMPDIR isn't final until the whole base configuration is parsed
+        bb.parse.ConfHandler.set_conf_ast_cachedir(None)
         try:
             self.data = self.parseConfigurationFiles(self.prefiles, self.postfiles)
 
@@ -303,6 +305,10 @@ class CookerDataBuilder(object):
             logger.error(str(e))
             raise bb.BBHandledException()
 
+        tmpdir = self.data.getVar("TMPDIR")
+        if tmpdir and os.path.isabs(tmpdir):
+            bb.parse.ConfHandler.set_conf_ast_cachedir(os.path.join(tmpdir, "cache", "conf_ast"))
+
         bb.codeparser.update_module_dependencies(self.data)
 
         # Handle obsolete variable names
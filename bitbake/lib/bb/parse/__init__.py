@@ -15,18 +15,22 @@ File parsers for the BitBake build tools.
 #
 
 handlers = []
-# Cache mapping file extensions to the handler dict for faster dispatch
-_supports_cache = {}
+# File extension → handler dict, filled in by register_handler()
+_ext_to_handler = {}
 try:
     from bb.parse import metrics as _bb_metrics
+    if not _bb_metrics.ENABLED:
+        _bb_metrics = None
 except Exception:
     _bb_metrics = None
 
 import errno
-from collections import deque
+from collections import OrderedDict
 import logging
 import os
 import stat
+import time
+import weakref
 import bb
 import bb.utils
 import bb.siggen
@@ -54,27 +58,38 @@ class SkipPackage(SkipRecipe):
     """Exception raised to skip this recipe (use SkipRecipe in new code)"""
 
 __mtime_cache = {}
-# Maximum entries for resolve_file() memoization
+# resolve_file() memoization, kept in LRU order (oldest first)
+_resolve_cache = OrderedDict()
 _RESOLVE_CACHE_MAX = 8192
+# Files resolve_file() failed to find, same policy as above
+_resolve_neg_cache = OrderedDict()
+_RESOLVE_NEG_CACHE_MAX = 4096
+# Switches for the caches above, read once rather than on every call
+_DISABLE_RESOLVE_CACHE = bool(os.environ.get('BB_OPT_DISABLE_RESOLVE_CACHE'))
+_DISABLE_NEG_RESOLVE_CACHE = _DISABLE_RESOLVE_CACHE or bool(os.environ.get('BB_OPT_DISABLE_NEG_RESOLVE_CACHE'))
+
+def _mtime_fingerprint(st):
+    # A single int rather than a (mtime, ino, size) tuple: cheaper to store
+    # and compare for the thousands of files marked as dependencies. Only
+    # the low 32 bits of the size are kept, the other fields are exact.
+    return (st.st_mtime_ns << 96) | (st.st_ino << 32) | (st.st_size & 0xffffffff)
+
 def cached_mtime(f):
     if f not in __mtime_cache:
-        res = os.stat(f)
-        __mtime_cache[f] = (res.st_mtime_ns, res.st_size, res.st_ino)
+        __mtime_cache[f] = _mtime_fingerprint(os.stat(f))
     return __mtime_cache[f]
 
 def cached_mtime_noerror(f):
     if f not in __mtime_cache:
         try:
-            res = os.stat(f)
-            __mtime_cache[f] = (res.st_mtime_ns, res.st_size, res.st_ino)
+            __mtime_cache[f] = _mtime_fingerprint(os.stat(f))
         except OSError:
             return 0
     return __mtime_cache[f]
 
 def check_mtime(f, mtime):
     try:
-        res = os.stat(f)
-        current_mtime = (res.st_mtime_ns, res.st_size, res.st_ino)
+        current_mtime = _mtime_fingerprint(os.stat(f))
         __mtime_cache[f] = current_mtime
     except OSError:
         current_mtime = 0
@@ -82,8 +97,7 @@ def check_mtime(f, mtime):
 
 def update_mtime(f):
     try:
-        res = os.stat(f)
-        __mtime_cache[f] = (res.st_mtime_ns, res.st_size, res.st_ino)
+        __mtime_cache[f] = _mtime_fingerprint(os.stat(f))
     except OSError:
         if f in __mtime_cache:
             del __mtime_cache[f]
@@ -95,42 +109,114 @@ def update_cache(f):
         logger.debug("Updating mtime cache for %s" % f)
         update_mtime(f)
 
+def _env_float(name, default):
+    """Return environment variable name as a float, or default if it is
+    unset or malformed"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning("Ignoring invalid %s value '%s'", name, value)
+        return default
+
+# Directory fingerprints of the handlers' indexes by key, with the time until
+# which each is trusted without stat()ing the directories again
+_dirs_fp_ts = {}
+_dirs_fp_ttl = _env_float('BB_OPT_DIRS_FP_TTL', 1.0)
+
+def _trusted_fingerprint(key, fingerprint, dirs):
+    """Return fingerprint(dirs), reusing the result recorded for key if it
+    is less than BB_OPT_DIRS_FP_TTL seconds old"""
+    now = time.monotonic()
+    ent = _dirs_fp_ts.get(key)
+    if ent is not None and now < ent[1]:
+        return ent[0]
+    fp = fingerprint(dirs)
+    _dirs_fp_ts[key] = (fp, now + _dirs_fp_ttl)
+    return fp
+
+def _trust_fingerprint(key, fp):
+    """Record fp, just taken, as the fingerprint for key"""
+    _dirs_fp_ts[key] = (fp, time.monotonic() + _dirs_fp_ttl)
+
+def _forget_fingerprint(key):
+    _dirs_fp_ts.pop(key, None)
+
 def clear_cache():
     global __mtime_cache
     __mtime_cache = {}
+    _resolve_neg_cache.clear()
+    # which() remembers misses too, which would hide newly created files
+    bb.utils._which_cache_clear()
+    _dirs_fp_ts.clear()
+
+# id(datastore) → {varname: [set, length, last entry]} mirroring list
+# variables such as __depends for O(1) membership tests. This lives outside
+# the datastore because getVar() returns copies, which would leave a shared
+# set out of step between a datastore and its copies. Entries are dropped
+# when their datastore is collected.
+_list_sets = {}
+
+def _list_set(d, var, values):
+    """Return a set of the entries of values, the current content of the
+    list variable var in d. The set is reused while values still has the
+    length and last entry it was last seen with, otherwise it is rebuilt
+    (e.g. after var was replaced or renamed)."""
+    sets = _list_sets.get(id(d))
+    if sets is None:
+        sets = _list_sets[id(d)] = {}
+        weakref.finalize(d, _list_sets.pop, id(d), None)
+    ent = sets.get(var)
+    if ent is not None and ent[1] == len(values) and (not values or ent[2] == values[-1]):
+        return ent[0]
+    vset = set(values)
+    sets[var] = [vset, len(values), values[-1] if values else None]
+    return vset
+
+def _list_set_append(d, var, values, vset, item):
+    """Append item to values and its set from _list_set(), and store values in var"""
+    values.append(item)
+    vset.add(item)
+    d.setVar(var, values)
+    ent = _list_sets[id(d)][var]
+    ent[1] = len(values)
+    ent[2] = item
 
 def mark_dependency(d, f):
     if f.startswith('./'):
         f = "%s/%s" % (os.getcwd(), f[2:])
     deps = (d.getVar('__depends', False) or [])
+    depset = _list_set(d, '__depends', deps)
     s = (f, cached_mtime_noerror(f))
-    if s not in deps:
-        deps.append(s)
-        d.setVar('__depends', deps)
+    if s not in depset:
+        _list_set_append(d, '__depends', deps, depset, s)
 
 def check_dependency(d, f):
     s = (f, cached_mtime_noerror(f))
     deps = (d.getVar('__depends', False) or [])
-    return s in deps
-   
+    return s in _list_set(d, '__depends', deps)
+
+def register_handler(exts, handler):
+    """Add a handler dict and map each of the file extensions in exts to it"""
+    handlers.append(handler)
+    for ext in exts:
+        _ext_to_handler[ext] = handler
+
 def _get_handler(fn, data):
     """Return the handler dict for this filename or None"""
-    ext = os.path.splitext(fn)[1]
-    if not os.environ.get('BB_OPT_DISABLE_SUPPORTS_CACHE') and ext in _supports_cache:
+    h = _ext_to_handler.get(os.path.splitext(fn)[1])
+    if h is not None:
         if _bb_metrics:
             _bb_metrics.hit('supports')
-        return _supports_cache[ext]
+        return h
+    # Handlers registered without extensions have to be asked directly
+    if _bb_metrics:
+        _bb_metrics.miss('supports')
     for h in handlers:
         if h['supports'](fn, data):
-            if not os.environ.get('BB_OPT_DISABLE_SUPPORTS_CACHE'):
-                _supports_cache[ext] = h
-            if _bb_metrics:
-                _bb_metrics.miss('supports')
             return h
-    if not os.environ.get('BB_OPT_DISABLE_SUPPORTS_CACHE'):
-        _supports_cache[ext] = None
-    if _bb_metrics:
-        _bb_metrics.miss('supports')
     return None
 
 def supports(fn, data):
@@ -159,13 +245,6 @@ def resolve_file(fn, d):
     # Lightweight memoization of resolution to cut repeated BBPATH scans
     # Key on (requested fn, absolute flag, BBPATH). Attempts are re-marked
     # every call to preserve dependency tracking semantics.
-    global _resolve_cache, _resolve_cache_order
-    try:
-        _resolve_cache
-    except NameError:
-        _resolve_cache = {}
-        _resolve_cache_order = deque()
-
     m = _bb_metrics
     _tok = None
     if m:
@@ -177,29 +256,39 @@ def resolve_file(fn, d):
         if not os.path.isabs(fn):
             bbpath = d.getVar("BBPATH")
             key = (fn, False, bbpath)
-            disable_cache = os.environ.get('BB_OPT_DISABLE_RESOLVE_CACHE')
+            disable_cache = _DISABLE_RESOLVE_CACHE
+            disable_neg_cache = _DISABLE_NEG_RESOLVE_CACHE
             cached = None if disable_cache else _resolve_cache.get(key)
+            negcached = None if cached is not None or disable_neg_cache else _resolve_neg_cache.get(key)
             if cached is not None:
                 newfn, attempts = cached
-                # Refresh simple LRU order
-                try:
-                    _resolve_cache_order.remove(key)
-                except ValueError:
-                    pass
-                _resolve_cache_order.append(key)
+                # Refresh LRU order
+                _resolve_cache.move_to_end(key)
                 if _bb_metrics:
                     _bb_metrics.hit('resolve_file')
+            elif negcached is not None:
+                newfn, attempts = None, negcached
+                _resolve_neg_cache.move_to_end(key)
+                if _bb_metrics:
+                    _bb_metrics.hit('resolve_file_neg')
             else:
                 newfn, attempts = bb.utils.which(bbpath, fn, history=True)
-                # Maintain bounded cache size
-                if not disable_cache:
+                # Maintain bounded cache sizes, misses are kept separately so
+                # that probes for optional files don't evict resolved ones
+                if newfn and not disable_cache:
                     _resolve_cache[key] = (newfn, tuple(attempts))
-                    _resolve_cache_order.append(key)
-                    if len(_resolve_cache_order) > _RESOLVE_CACHE_MAX:
-                        old = _resolve_cache_order.popleft()
-                        _resolve_cache.pop(old, None)
+                    _resolve_cache.move_to_end(key)
+                    if len(_resolve_cache) > _RESOLVE_CACHE_MAX:
+                        _resolve_cache.popitem(last=False)
                         if _bb_metrics:
                             _bb_metrics.evict('resolve_file')
+                elif not newfn and not disable_neg_cache:
+                    _resolve_neg_cache[key] = tuple(attempts)
+                    _resolve_neg_cache.move_to_end(key)
+                    if len(_resolve_neg_cache) > _RESOLVE_NEG_CACHE_MAX:
+                        _resolve_neg_cache.popitem(last=False)
+                        if _bb_metrics:
+                            _bb_metrics.evict('resolve_file_neg')
                 if _bb_metrics:
                     _bb_metrics.miss('resolve_file')
 
@@ -227,20 +316,17 @@ __pkgsplit_cache__={}
 def vars_from_file(mypkg, d):
     if not mypkg or not mypkg.endswith((".bb", ".bbappend")):
         return (None, None, None)
-    if mypkg in __pkgsplit_cache__:
-        return __pkgsplit_cache__[mypkg]
+    # Only the basename is used, so recipes and bbappends sharing a name
+    # in different layers can share the entry
+    base = os.path.basename(mypkg)
+    if base in __pkgsplit_cache__:
+        return __pkgsplit_cache__[base]
 
-    myfile = os.path.splitext(os.path.basename(mypkg))
-    parts = myfile[0].split('_')
-    __pkgsplit_cache__[mypkg] = parts
+    parts = os.path.splitext(base)[0].split('_')
     if len(parts) > 3:
         raise ParseError("Unable to generate default variables from filename (too many underscores)", mypkg)
-    exp = 3 - len(parts)
-    tmplist = []
-    while exp != 0:
-        exp -= 1
-        tmplist.append(None)
-    parts.extend(tmplist)
+    parts.extend([None] * (3 - len(parts)))
+    __pkgsplit_cache__[base] = parts
     return parts
 
 def get_file_depends(d):
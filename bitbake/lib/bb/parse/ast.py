@@ -100,67 +100,82 @@ class DataNode(AstNode):
     this need to be re-evaluated... we might be able to do
     that faster with multiple classes.
     """
-    def __init__(self, filename, lineno, groupd):
+    # The parts of an assignment, in the order they are passed in groups.
+    # Operators which weren't used are None.
+    fields = ("exp", "var", "flag", "lazyques", "ques", "colon", "append",
+              "prepend", "postdot", "predot", "value")
+
+    def __init__(self, filename, lineno, groups):
         AstNode.__init__(self, filename, lineno)
-        self.groupd = groupd
+        self.groups = self._intern_names(groups)
+
+    @staticmethod
+    def _intern_names(groups):
+        # The same names recur across many files and end up as datastore keys
+        flag = groups[2]
+        if flag is not None:
+            flag = sys.intern(flag)
+        return (groups[0], sys.intern(groups[1]), flag) + tuple(groups[3:])
+
+    def __setstate__(self, state):
+        # Unpickling (e.g. from the conf AST disk cache) bypasses __init__
+        self.__dict__.update(state)
+        self.groups = self._intern_names(self.groups)
 
     def getFunc(self, key, data):
-        if 'flag' in self.groupd and self.groupd['flag'] is not None:
-            return data.getVarFlag(key, self.groupd['flag'], expand=False, noweakdefault=True)
+        flag = self.groups[2]
+        if flag is not None:
+            return data.getVarFlag(key, flag, expand=False, noweakdefault=True)
         else:
             return data.getVar(key, False, noweakdefault=True, parsing=True)
 
     def eval(self, data):
-        groupd = self.groupd
-        key = groupd["var"]
+        exp, key, flag, lazyques, ques, colon, append, prepend, postdot, predot, value = self.groups
         loginfo = {
             'variable': key,
             'file': self.filename,
             'line': self.lineno,
         }
-        if "exp" in groupd and groupd["exp"] is not None:
+        if exp is not None:
             data.setVarFlag(key, "export", 1, op = 'exported', **loginfo)
 
         op = "set"
-        if "ques" in groupd and groupd["ques"] is not None:
+        if ques is not None:
             val = self.getFunc(key, data)
             op = "set?"
             if val is None:
-                val = groupd["value"]
-        elif "colon" in groupd and groupd["colon"] is not None:
+                val = value
+        elif colon is not None:
             e = data.createCopy()
             op = "immediate"
-            val = e.expand(groupd["value"], key + "[:=]")
-        elif "append" in groupd and groupd["append"] is not None:
+            val = e.expand(value, key + "[:=]")
+        elif append is not None:
             op = "append"
-            val = "%s %s" % ((self.getFunc(key, data) or ""), groupd["value"])
-        elif "prepend" in groupd and groupd["prepend"] is not None:
+            val = "%s %s" % ((self.getFunc(key, data) or ""), value)
+        elif prepend is not None:
             op = "prepend"
-            val = "%s %s" % (groupd["value"], (self.getFunc(key, data) or ""))
-        elif "postdot" in groupd and groupd["postdot"] is not None:
+            val = "%s %s" % (value, (self.getFunc(key, data) or ""))
+        elif postdot is not None:
             op = "postdot"
-            val = "%s%s" % ((self.getFunc(key, data) or ""), groupd["value"])
-        elif "predot" in groupd and groupd["predot"] is not None:
+            val = "%s%s" % ((self.getFunc(key, data) or ""), value)
+        elif predot is not None:
             op = "predot"
-            val = "%s%s" % (groupd["value"], (self.getFunc(key, data) or ""))
+            val = "%s%s" % (value, (self.getFunc(key, data) or ""))
         else:
-            val = groupd["value"]
+            val = value
 
         if ":append" in key or ":remove" in key or ":prepend" in key:
-            if op in ["append", "prepend", "postdot", "predot", "ques"]:
-                bb.warn(key + " " + groupd[op] + " is not a recommended operator combination, please replace it.")
+            if op in ["append", "prepend", "postdot", "predot"]:
+                bb.warn(key + " " + (append or prepend or postdot or predot) + " is not a recommended operator combination, please replace it.")
 
-        flag = None
-        if 'flag' in groupd and groupd['flag'] is not None:
-            if groupd["lazyques"]:
-                flag = "_defaultval_flag_"+groupd['flag']
-            else:
-                flag = groupd['flag']
-        elif groupd["lazyques"]:
+        if flag is not None:
+            if lazyques:
+                flag = "_defaultval_flag_" + flag
+        elif lazyques:
             flag = "_defaultval"
 
         loginfo['op'] = op
-        loginfo['detail'] = groupd["value"]
+        loginfo['detail'] = value
 
         if flag:
             data.setVarFlag(key, flag, val, **loginfo)
@@ -405,8 +420,9 @@ def handleUnset(statements, filename, lineno, m):
 def handleUnsetFlag(statements, filename, lineno, m):
     statements.append(UnsetFlagNode(filename, lineno, m.group(1), m.group(2)))
 
-def handleData(statements, filename, lineno, groupd):
-    statements.append(DataNode(filename, lineno, groupd))
+def handleData(statements, filename, lineno, groups):
+    """groups holds the values of DataNode.fields, in that order"""
+    statements.append(DataNode(filename, lineno, groups))
 
 def handleMethod(statements, filename, lineno, func_name, body, python, fakeroot):
     statements.append(MethodNode(filename, lineno, func_name, body, python, fakeroot))
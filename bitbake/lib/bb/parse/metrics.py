@@ -3,36 +3,55 @@ import json
 import os
 import threading
 import itertools
-from time import time, perf_counter
+from time import time, perf_counter_ns
+
+# Metrics are only collected when BB_OPT_METRICS is set to a non-zero value.
+# Callers check ENABLED (or hold no reference to this module) so that the
+# parse hot paths don't pay for counters nobody reads.
+ENABLED = os.environ.get('BB_OPT_METRICS', '0') not in ('', '0')
 
 _lock = threading.Lock()
-_totals = {
-    'which': {'hits': 0, 'misses': 0, 'evictions': 0},
-    'resolve_file': {'hits': 0, 'misses': 0, 'evictions': 0},
-    'inherit': {'hits': 0, 'misses': 0, 'evictions': 0},
-    'include': {'hits': 0, 'misses': 0, 'evictions': 0},
-    'conf_ast': {'hits': 0, 'misses': 0, 'evictions': 0},
-    'supports': {'hits': 0, 'misses': 0, 'evictions': 0},
+
+# Sections always reported by flush(), even if never bumped
+_counter_sections = (
+    'which',
+    'resolve_file',
+    'resolve_file_neg',
+    'inherit',
+    'include',
+    'conf_ast',
+    'conf_ast_disk',
+    'supports',
     # Index attribution counters
-    'include_index': {'hits': 0, 'misses': 0, 'evictions': 0},
-    'class_index': {'hits': 0, 'misses': 0, 'evictions': 0},
-    'which_dir_index': {'hits': 0, 'misses': 0, 'evictions': 0},
-}
-
-# Cumulative time (seconds) and counts per section
-_times = {
-    'which': {'seconds': 0.0, 'count': 0},
-    'resolve_file': {'seconds': 0.0, 'count': 0},
-    'inherit': {'seconds': 0.0, 'count': 0},
-    'include': {'seconds': 0.0, 'count': 0},
-    'conf_ast_parse': {'seconds': 0.0, 'count': 0},
-    'conf_eval': {'seconds': 0.0, 'count': 0},
-    'supports': {'seconds': 0.0, 'count': 0},
-}
+    'include_index',
+    'class_index',
+    'which_dir_index',
+)
+_time_sections = (
+    'which',
+    'resolve_file',
+    'inherit',
+    'include',
+    'conf_ast_parse',
+    'conf_eval',
+    'supports',
+)
+
+# Counters are kept per thread so the hot paths never take _lock; each
+# thread registers its (counts, times) pair once and flush() sums them.
+# counts maps (section, field) to an int, times maps section to
+# [nanoseconds, count].
+_local = threading.local()
+_thread_stats = []
 
 _metrics_path = None
 _seq = itertools.count(1)
 
+# Serialised snapshots not yet written by flush(), and the pid they belong to
+_pending = []
+_pending_pid = None
+_write_every = 32
+
 
 def set_tmpdir(tmpdir):
     global _metrics_path
@@ -43,12 +62,20 @@ def set_tmpdir(tmpdir):
         pass
 
 
+def _stats():
+    try:
+        return _local.stats
+    except AttributeError:
+        stats = _local.stats = ({}, {})
+        with _lock:
+            _thread_stats.append(stats)
+        return stats
+
+
 def _bump(section, field, n=1):
-    with _lock:
-        try:
-            _totals[section][field] += n
-        except Exception:
-            pass
+    counts = _stats()[0]
+    key = (section, field)
+    counts[key] = counts.get(key, 0) + n
 
 
 def hit(section):
@@ -63,53 +90,82 @@ def evict(section):
     _bump(section, 'evictions', 1)
 
 def time_start(section):
-    try:
-        return (section, perf_counter())
-    except Exception:
-        return None
+    return (section, perf_counter_ns())
 
 def time_end(section, token):
-    try:
-        if not token:
-            return
-        sec, t0 = token
-        if sec != section:
-            section = sec
-        dt = perf_counter() - t0
-        with _lock:
-            ent = _times.get(section)
-            if ent is None:
-                ent = {'seconds': 0.0, 'count': 0}
-                _times[section] = ent
-            ent['seconds'] += dt
-            ent['count'] += 1
-    except Exception:
-        pass
-
-
-def flush(note=None):
-    # Append cumulative totals to file; do not reset
+    if not token:
+        return
+    section, t0 = token
+    dt = perf_counter_ns() - t0
+    times = _stats()[1]
+    ent = times.get(section)
+    if ent is None:
+        ent = times[section] = [0, 0]
+    ent[0] += dt
+    ent[1] += 1
+
+
+def _merged():
+    totals = {sec: {'hits': 0, 'misses': 0, 'evictions': 0} for sec in _counter_sections}
+    times = {sec: {'seconds': 0.0, 'count': 0} for sec in _time_sections}
+    with _lock:
+        stats = list(_thread_stats)
+    for counts, thread_times in stats:
+        for (sec, field), n in list(counts.items()):
+            ent = totals.setdefault(sec, {'hits': 0, 'misses': 0, 'evictions': 0})
+            ent[field] = ent.get(field, 0) + n
+        for sec, (ns, count) in list(thread_times.items()):
+            ent = times.setdefault(sec, {'seconds': 0.0, 'count': 0})
+            ent['seconds'] += ns / 1e9
+            ent['count'] += count
+    return totals, times
+
+
+def flush(note=None, force=False):
+    """Record a snapshot of the cumulative totals; they are never reset.
+    Snapshots are buffered and appended to the metrics file in batches of
+    _write_every, or immediately if force is set."""
+    global _pending_pid
     p = _metrics_path or os.path.join(os.environ.get('TMPDIR') or '/tmp', 'bb-cache-metrics.jsonl')
+    pid = os.getpid()
     payload = {
         'ts': time(),
-        'pid': os.getpid(),
+        'pid': pid,
         'seq': next(_seq),
         'note': note,
     }
+    totals, times = _merged()
+    payload.update(totals)
+    payload['time'] = times
+    line = json.dumps(payload) + "\n"
     with _lock:
-        payload.update(_totals)
-        payload['time'] = _times
+        # Snapshots buffered by the parent before a fork aren't ours to write
+        if _pending_pid != pid:
+            _pending.clear()
+            _pending_pid = pid
+        _pending.append(line)
+        if not force and len(_pending) < _write_every:
+            return
+        lines = "".join(_pending)
+        _pending.clear()
     try:
         os.makedirs(os.path.dirname(p), exist_ok=True)
         with open(p, 'a') as f:
-            f.write(json.dumps(payload) + "\n")
+            f.write(lines)
     except Exception:
         pass
 
 
-@atexit.register
-def _on_exit():
-    try:
-        flush('exit')
-    except Exception:
-        pass
+def _noop(*args, **kwargs):
+    return None
+
+
+if ENABLED:
+    @atexit.register
+    def _on_exit():
+        try:
+            flush('exit', True)
+        except Exception:
+            pass
+else:
+    hit = miss = evict = time_start = time_end = flush = _noop
@@ -12,11 +12,13 @@
 # SPDX-License-Identifier: GPL-2.0-only
 #
 
-import re, bb, os
+import re, bb, os, stat
 import bb.build, bb.utils, bb.data_smart
+from collections import OrderedDict
 
 from . import ConfHandler
-from .. import resolve_file, ast, logger, ParseError
+from .. import resolve_file, ast, logger, ParseError, _list_set, _list_set_append, \
+    _trusted_fingerprint, _trust_fingerprint, _forget_fingerprint
 from .ConfHandler import include, init
 
 __func_start_regexp__    = re.compile(r"(((?P<py>python(?=(\s|\()))|(?P<fr>fakeroot(?=\s)))\s*)*(?P<func>[\w\.\-\+\{\}\$:]+)?\s*\(\s*\)\s*{$" )
@@ -30,6 +32,20 @@ __def_regexp__           = re.compile(r"def\s+(\w+).*:" )
 __python_func_regexp__   = re.compile(r"(\s+.*)|(^$)|(^#)" )
 __python_tab_regexp__    = re.compile(r" *\t")
 
+# Statement keyword → the only regexp which can match a line starting with it
+__keyword_regexps__ = {
+    "def": __def_regexp__,
+    "EXPORT_FUNCTIONS": __export_func_regexp__,
+    "addtask": __addtask_regexp__,
+    "deltask": __deltask_regexp__,
+    "addhandler": __addhandler_regexp__,
+    "inherit": __inherit_regexp__,
+    "inherit_defer": __inherit_def_regexp__,
+}
+
+# File extensions handled by this parser
+_BB_EXTS = frozenset((".bb", ".bbclass", ".inc"))
+
 __infunc__ = []
 __inpython__ = False
 __body__   = []
@@ -37,44 +53,84 @@ __classname__ = ""
 __residue__ = []
 
 cached_statements = {}
+# Recipe/bbappend path → ((mtime_ns, size), statements), in LRU order
+_stmt_cache = OrderedDict()
+_stmt_cache_max = 64
 try:
     from bb.parse import metrics as _bb_metrics
+    if not _bb_metrics.ENABLED:
+        _bb_metrics = None
 except Exception:
     _bb_metrics = None
-_inherit_resolved_cache = {}
-_inherit_resolved_order = []
+# Resolved inherits, kept in LRU order (oldest first)
+_inherit_resolved_cache = OrderedDict()
 _inherit_resolved_max = 8192
 
 # Class name → absolute path index per (BBPATH, classtype) to avoid repeated which() scans
-_class_index_cache = {}
-_class_index_order = []
+_class_index_cache = OrderedDict()
 _class_index_max = 128
-
-def _bbpath_dirs_for_classes(bbpath, classtype):
-    dirs = []
-    for p in (bbpath or '').split(':'):
-        if not p:
-            continue
-        for t in ["classes-" + str(classtype), "classes"]:
-            d = os.path.join(p, t)
-            if os.path.isdir(d):
-                dirs.append(d)
+_disable_class_index = bool(os.environ.get('BB_OPT_DISABLE_CLASS_INDEX'))
+
+# BBPATH value → whether any entry is relative (or empty, i.e. the cwd)
+_bbpath_relative = {}
+
+def _bbpath_key(bbpath):
+    """Return a cache key for bbpath, qualified by the cwd if it has relative entries"""
+    rel = _bbpath_relative.get(bbpath)
+    if rel is None:
+        rel = _bbpath_relative[bbpath] = not all(os.path.isabs(p) for p in (bbpath or '').split(':'))
+    if rel:
+        return (bbpath, os.getcwd())
+    return bbpath
+
+# (classtype, BBPATH key) → candidate class directories
+_class_dirs_cache = {}
+
+def _class_dirs(bbpath, classtype):
+    """Return the candidate class directories in search order. Empty BBPATH
+    entries mean the cwd, as they do for bb.utils.which()."""
+    key = (classtype, _bbpath_key(bbpath))
+    dirs = _class_dirs_cache.get(key)
+    if dirs is None:
+        dirs = []
+        for p in (bbpath or '').split(':'):
+            for t in ("classes-" + str(classtype), "classes"):
+                dirs.append(os.path.abspath(os.path.join(p, t)))
+        dirs = _class_dirs_cache[key] = tuple(dirs)
     return dirs
 
-def _dirs_fingerprint(dirs):
+def _dirs_fingerprint(candidates):
+    """Return the fingerprint of the directories which exist among candidates"""
     fp = []
-    for d in dirs:
+    for d in candidates:
         try:
             st = os.stat(d)
-            fp.append((d, st.st_mtime_ns, st.st_ino))
         except OSError:
-            fp.append((d, 0, 0))
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            fp.append((d, st.st_mtime_ns, st.st_ino))
     return tuple(fp)
 
+def _class_attempts(candidates, cls):
+    name = cls + '.bbclass'
+    return tuple(os.path.join(d, name) for d in candidates)
+
 def _build_class_index(bbpath, classtype):
-    dirs = _bbpath_dirs_for_classes(bbpath, classtype)
+    """Return (fingerprint, mapping, attempts) where mapping maps class names
+    to their path and attempts maps them to every candidate path in search
+    order, for dependency marking. Each directory is stat()ed once, for both
+    the existence check and the fingerprint, before it is scanned."""
+    candidates = _class_dirs(bbpath, classtype)
+    fp = []
     mapping = {}
-    for d in dirs:
+    for d in candidates:
+        try:
+            st = os.stat(d)
+        except OSError:
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+        fp.append((d, st.st_mtime_ns, st.st_ino))
         try:
             with os.scandir(d) as it:
                 for de in it:
@@ -87,51 +143,48 @@ def _build_class_index(bbpath, classtype):
                         mapping[cls] = os.path.join(d, name)
         except OSError:
             continue
-    return _dirs_fingerprint(dirs), mapping
+    attempts = {cls: _class_attempts(candidates, cls) for cls in mapping}
+    return tuple(fp), mapping, attempts
 
 def _get_class_index(bbpath, classtype):
-    key = (str(classtype), bbpath or '')
+    """Return (mapping, attempts) as built by _build_class_index()"""
+    key = (str(classtype), _bbpath_key(bbpath))
     cached = _class_index_cache.get(key)
-    dirs = _bbpath_dirs_for_classes(bbpath, classtype)
-    fp = _dirs_fingerprint(dirs)
+    fpkey = ("class",) + key
+    fp = _trusted_fingerprint(fpkey, _dirs_fingerprint, _class_dirs(bbpath, classtype))
     if cached is not None:
-        cfp, cmap = cached
+        cfp, cmap, cattempts = cached
         if cfp == fp:
             # Refresh LRU
-            try:
-                _class_index_order.remove(key)
-            except ValueError:
-                pass
-            _class_index_order.append(key)
-            return cmap
+            _class_index_cache.move_to_end(key)
+            return cmap, cattempts
     # (Re)build
-    fp, cmap = _build_class_index(bbpath, classtype)
-    _class_index_cache[key] = (fp, cmap)
-    _class_index_order.append(key)
-    if len(_class_index_order) > _class_index_max:
-        old = _class_index_order.pop(0)
-        _class_index_cache.pop(old, None)
-    return cmap
+    fp, cmap, cattempts = _build_class_index(bbpath, classtype)
+    _trust_fingerprint(fpkey, fp)
+    _class_index_cache[key] = (fp, cmap, cattempts)
+    _class_index_cache.move_to_end(key)
+    if len(_class_index_cache) > _class_index_max:
+        old, _ = _class_index_cache.popitem(last=False)
+        _forget_fingerprint(("class",) + old)
+    return cmap, cattempts
 
 def _inherit_cache_get(key):
     try:
-        _inherit_resolved_order.remove(key)
-        _inherit_resolved_order.append(key)
         val = _inherit_resolved_cache[key]
+        _inherit_resolved_cache.move_to_end(key)
         if _bb_metrics:
             _bb_metrics.hit('inherit')
         return val
-    except (ValueError, KeyError):
+    except KeyError:
         if _bb_metrics:
             _bb_metrics.miss('inherit')
         return None
 
 def _inherit_cache_put(key, value):
     _inherit_resolved_cache[key] = value
-    _inherit_resolved_order.append(key)
-    if len(_inherit_resolved_order) > _inherit_resolved_max:
-        old = _inherit_resolved_order.pop(0)
-        _inherit_resolved_cache.pop(old, None)
+    _inherit_resolved_cache.move_to_end(key)
+    if len(_inherit_resolved_cache) > _inherit_resolved_max:
+        _inherit_resolved_cache.popitem(last=False)
         if _bb_metrics:
             _bb_metrics.evict('inherit')
 
@@ -150,7 +203,7 @@ def _resolve_inherit_file(d, origfile):
     try:
         classtype = d.getVar("__bbclasstype", False)
         bbpath = d.getVar("BBPATH")
-        key = (origfile, classtype, bbpath)
+        key = (origfile, classtype, _bbpath_key(bbpath))
 
         if not os.path.isabs(origfile) and not origfile.endswith(".bbclass"):
             cached = _inherit_cache_get(key)
@@ -162,7 +215,7 @@ def _resolve_inherit_file(d, origfile):
             # If the class reference contains subdirectories, fall back to path-based resolution
             if '/' in origfile:
                 for t in ["classes-" + str(classtype), "classes"]:
-                    cand = os.path.join(t, '%s.bbclass' % origfile)
+                    cand = os.path.join(t, origfile + '.bbclass')
                     abs_fn, attempts = bb.utils.which(bbpath, cand, history=True)
                     attempts_accum.extend(attempts)
                     if abs_fn:
@@ -170,10 +223,11 @@ def _resolve_inherit_file(d, origfile):
                         break
             else:
                 # Use class index to map class name to path in O(1)
-                if os.environ.get('BB_OPT_DISABLE_CLASS_INDEX'):
+                cattempts = None
+                if _disable_class_index:
                     # Simulate miss by falling back to which()
                     for t in ["classes-" + str(classtype), "classes"]:
-                        cand = os.path.join(t, '%s.bbclass' % origfile)
+                        cand = os.path.join(t, origfile + '.bbclass')
                         abs_fn, attempts = bb.utils.which(bbpath, cand, history=True)
                         attempts_accum.extend(attempts)
                         if abs_fn:
@@ -182,7 +236,7 @@ def _resolve_inherit_file(d, origfile):
                     if _bb_metrics:
                         _bb_metrics.miss('class_index')
                 else:
-                    cmap = _get_class_index(bbpath, classtype)
+                    cmap, cattempts = _get_class_index(bbpath, classtype)
                     resolved = cmap.get(origfile)
                     if _bb_metrics:
                         # Count any lookup through index as a hit regardless of found status
@@ -190,13 +244,16 @@ def _resolve_inherit_file(d, origfile):
                             _bb_metrics.hit('class_index')
                         else:
                             _bb_metrics.miss('class_index')
-                # Generate attempts list in search order for dependency marking
-                for p in (bbpath or '').split(':'):
-                    if not p:
-                        continue
-                    for t in ["classes-" + str(classtype), "classes"]:
-                        cand = os.path.abspath(os.path.join(p, t, '%s.bbclass' % origfile))
-                        attempts_accum.append(cand)
+                # Attempts list in search order for dependency marking,
+                # precomputed by the class index for the classes it found
+                attempts = cattempts.get(origfile) if cattempts else None
+                if attempts is None:
+                    attempts = _class_attempts(_class_dirs(bbpath, classtype), origfile)
+                if attempts_accum:
+                    attempts = tuple(attempts_accum) + attempts
+                val = (resolved, attempts)
+                _inherit_cache_put(key, val)
+                return val
 
             val = (resolved, tuple(attempts_accum))
             _inherit_cache_put(key, val)
@@ -213,7 +270,7 @@ def _resolve_inherit_file(d, origfile):
 
 def supports(fn, d):
     """Return True if fn has a supported extension"""
-    return os.path.splitext(fn)[-1] in [".bb", ".bbclass", ".inc"]
+    return os.path.splitext(fn)[1] in _BB_EXTS
 
 def inherit_defer(expression, fn, lineno, d):
     inherit = (expression, fn, lineno)
@@ -223,6 +280,7 @@ def inherit_defer(expression, fn, lineno, d):
 
 def inherit(files, fn, lineno, d, deferred=False):
     __inherit_cache = d.getVar('__inherit_cache', False) or []
+    inherited = _list_set(d, '__inherit_cache', __inherit_cache)
     #if "${" in files and not deferred:
     #    bb.warn("%s:%s has non deferred conditional inherit" % (fn, lineno))
     files = d.expand(files).split()
@@ -242,15 +300,17 @@ def inherit(files, fn, lineno, d, deferred=False):
         if not file or not os.path.exists(file):
             raise ParseError("Could not inherit file %s" % (file), fn, lineno)
 
-        if not file in __inherit_cache:
+        if not file in inherited:
             logger.debug("Inheriting %s (from %s:%d)" % (file, fn, lineno))
-            __inherit_cache.append( file )
-            d.setVar('__inherit_cache', __inherit_cache)
+            _list_set_append(d, '__inherit_cache', __inherit_cache, inherited, file)
             try:
                 bb.parse.handle(file, d, True)
             except (IOError, OSError) as exc:
                 raise ParseError("Could not inherit file %s: %s" % (fn, exc.strerror), fn, lineno)
+            # The class may have inherited others, the set stays valid as
+            # long as they were added through _list_set_append() too
             __inherit_cache = d.getVar('__inherit_cache', False) or []
+            inherited = _list_set(d, '__inherit_cache', __inherit_cache)
 
 def get_statements(filename, absolute_filename, base_name):
     global cached_statements, __residue__, __body__
@@ -258,26 +318,51 @@ def get_statements(filename, absolute_filename, base_name):
     try:
         return cached_statements[absolute_filename]
     except KeyError:
-        with open(absolute_filename, 'r') as f:
-            statements = ast.StatementGroup()
+        pass
 
-            lineno = 0
-            for lineno, line in enumerate(f, start=1):
-                s = line.rstrip()
-                feeder(lineno, s, filename, base_name, statements)
+    # Recipes and bbappends may be parsed repeatedly (e.g. once per
+    # multiconfig) but can also change under a long running server, so
+    # validate their cache entries against the file's mtime and size
+    stamp = None
+    if not filename.endswith((".bbclass", ".inc")):
+        st = os.stat(absolute_filename)
+        stamp = (st.st_mtime_ns, st.st_size)
+        cached = _stmt_cache.get(absolute_filename)
+        if cached is not None and cached[0] == stamp:
+            _stmt_cache.move_to_end(absolute_filename)
+            return cached[1]
+
+    with open(absolute_filename, 'r') as f:
+        lines = f.read().split('\n')
+    # A trailing newline doesn't start another line
+    if not lines[-1]:
+        lines.pop()
+
+    statements = ast.StatementGroup()
+    lineno = 0
+    for lineno, s in enumerate(lines, start=1):
+        # Trailing whitespace is still significant to feeder(), but
+        # without a line terminator rstrip() only copies when there is
+        # some to remove
+        feeder(lineno, s.rstrip(), filename, base_name, statements)
 
-        if __inpython__:
-            # add a blank line to close out any python definition
-            feeder(lineno, "", filename, base_name, statements, eof=True)
+    if __inpython__:
+        # add a blank line to close out any python definition
+        feeder(lineno, "", filename, base_name, statements, eof=True)
 
-        if __residue__:
-            raise ParseError("Unparsed lines %s: %s" % (filename, str(__residue__)), filename, lineno)
-        if __body__:
-            raise ParseError("Unparsed lines from unclosed function %s: %s" % (filename, str(__body__)), filename, lineno)
+    if __residue__:
+        raise ParseError("Unparsed lines %s: %s" % (filename, str(__residue__)), filename, lineno)
+    if __body__:
+        raise ParseError("Unparsed lines from unclosed function %s: %s" % (filename, str(__body__)), filename, lineno)
 
-        if filename.endswith(".bbclass") or filename.endswith(".inc"):
-            cached_statements[absolute_filename] = statements
-        return statements
+    if stamp is None:
+        cached_statements[absolute_filename] = statements
+    else:
+        _stmt_cache[absolute_filename] = (stamp, statements)
+        _stmt_cache.move_to_end(absolute_filename)
+        if len(_stmt_cache) > _stmt_cache_max:
+            _stmt_cache.popitem(last=False)
+    return statements
 
 def handle(fn, d, include, baseconfig=False):
     global __infunc__, __body__, __residue__, __classname__
@@ -290,18 +375,15 @@ def handle(fn, d, include, baseconfig=False):
     (root, ext) = os.path.splitext(base_name)
     init(d)
     # Tell metrics where TMPDIR is so it can write its file
-    try:
-        from bb.parse import metrics as _m
-        _m.set_tmpdir(d.getVar('TMPDIR'))
-    except Exception:
-        pass
+    if _bb_metrics:
+        _bb_metrics.set_tmpdir(d.getVar('TMPDIR'))
 
     if ext == ".bbclass":
         __classname__ = root
         __inherit_cache = d.getVar('__inherit_cache', False) or []
-        if not fn in __inherit_cache:
-            __inherit_cache.append(fn)
-            d.setVar('__inherit_cache', __inherit_cache)
+        inherited = _list_set(d, '__inherit_cache', __inherit_cache)
+        if not fn in inherited:
+            _list_set_append(d, '__inherit_cache', __inherit_cache, inherited, fn)
 
     if include != 0:
         oldfile = d.getVar('FILE', False)
@@ -322,11 +404,8 @@ def handle(fn, d, include, baseconfig=False):
     except bb.parse.SkipRecipe:
         d.setVar("__SKIPPED", True)
         if include == 0:
-            try:
-                from bb.parse import metrics as _m
-                _m.flush('bbhandler')
-            except Exception:
-                pass
+            if _bb_metrics:
+                _bb_metrics.flush('bbhandler')
             return { "" : d }
 
     if __infunc__:
@@ -335,11 +414,8 @@ def handle(fn, d, include, baseconfig=False):
         raise ParseError("Leftover unparsed (incomplete?) data %s from %s" % __residue__, fn)
 
     if ext != ".bbclass" and include == 0:
-        try:
-            from bb.parse import metrics as _m
-            _m.flush('bbhandler')
-        except Exception:
-            pass
+        if _bb_metrics:
+            _bb_metrics.flush('bbhandler')
         return ast.multi_finalize(fn, d)
 
     if ext != ".bbclass" and oldfile and abs_fn != oldfile:
@@ -347,7 +423,13 @@ def handle(fn, d, include, baseconfig=False):
 
     return d
 
-def feeder(lineno, s, fn, root, statements, eof=False):
+# The trailing keyword arguments bind the regexps as locals, this is called
+# for every line parsed
+def feeder(lineno, s, fn, root, statements, eof=False,
+           _tab_match=__python_tab_regexp__.match,
+           _pyfunc_match=__python_func_regexp__.match,
+           _func_start_match=__func_start_regexp__.match,
+           _keyword_regexps=__keyword_regexps__):
     global __inpython__, __infunc__, __body__, __residue__, __classname__
 
     # Check tabs in python functions:
@@ -355,7 +437,7 @@ def feeder(lineno, s, fn, root, statements, eof=False):
     # - python(): covered by '__anonymous' == __infunc__[0]
     # - python funcname(): covered by __infunc__[3]
     if __inpython__ or (__infunc__ and ('__anonymous' == __infunc__[0] or __infunc__[3])):
-        tab = __python_tab_regexp__.match(s)
+        tab = _tab_match(s)
         if tab:
             bb.warn('python should use 4 spaces indentation, but found tabs in %s, line %s' % (root, lineno))
 
@@ -370,7 +452,7 @@ def feeder(lineno, s, fn, root, statements, eof=False):
         return
 
     if __inpython__:
-        m = __python_func_regexp__.match(s)
+        m = _pyfunc_match(s)
         if m and not eof:
             __body__.append(s)
             return
@@ -405,25 +487,30 @@ def feeder(lineno, s, fn, root, statements, eof=False):
     if s[0] == '#':
         return
 
-    m = __func_start_regexp__.match(s)
-    if m:
-        __infunc__ = [m.group("func") or "__anonymous", fn, lineno, m.group("py") is not None, m.group("fr") is not None]
-        return
+    if s[-1] == '{':
+        m = _func_start_match(s)
+        if m:
+            __infunc__ = [m.group("func") or "__anonymous", fn, lineno, m.group("py") is not None, m.group("fr") is not None]
+            return
 
-    m = __def_regexp__.match(s)
-    if m:
+    # Lines not starting with a known keyword can only be handled by ConfHandler
+    words = s.split(None, 1)
+    kw = words[0] if words else ""
+    regexp = _keyword_regexps.get(kw)
+    m = regexp.match(s) if regexp else None
+    if not m:
+        return ConfHandler.feeder(lineno, s, fn, statements, conffile=False)
+
+    if kw == "def":
         __body__.append(s)
         __inpython__ = m.group(1)
-
         return
 
-    m = __export_func_regexp__.match(s)
-    if m:
+    if kw == "EXPORT_FUNCTIONS":
         ast.handleExportFuncs(statements, fn, lineno, m, __classname__)
         return
 
-    m = __addtask_regexp__.match(s)
-    if m:
+    if kw == "addtask":
         after = ""
         before = ""
 
@@ -451,31 +538,23 @@ def feeder(lineno, s, fn, root, statements, eof=False):
             ast.handleAddTask(statements, fn, lineno, tasks, before, after)
         return
 
-    m = __deltask_regexp__.match(s)
-    if m:
+    if kw == "deltask":
         task = m.group(1)
         if task is not None:
             ast.handleDelTask(statements, fn, lineno, task)
         return
 
-    m = __addhandler_regexp__.match(s)
-    if m:
+    if kw == "addhandler":
         ast.handleBBHandlers(statements, fn, lineno, m)
         return
 
-    m = __inherit_regexp__.match(s)
-    if m:
+    if kw == "inherit":
         ast.handleInherit(statements, fn, lineno, m)
         return
 
-    m = __inherit_def_regexp__.match(s)
-    if m:
-        ast.handleInheritDeferred(statements, fn, lineno, m)
-        return
-
-    return ConfHandler.feeder(lineno, s, fn, statements, conffile=False)
+    ast.handleInheritDeferred(statements, fn, lineno, m)
 
 # Add us to the handlers list
-from .. import handlers
-handlers.append({'supports': supports, 'handle': handle, 'init': init})
-del handlers
+from .. import register_handler
+register_handler(_BB_EXTS, {'supports': supports, 'handle': handle, 'init': init})
+del register_handler
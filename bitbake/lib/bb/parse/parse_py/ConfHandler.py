@@ -12,39 +12,31 @@
 #
 
 import errno
+import hashlib
+import logging
+import pickle
 import re
 import os
+from collections import OrderedDict
 import bb.utils
-from bb.parse import ParseError, resolve_file, ast, logger, handle
+from bb.parse import ParseError, resolve_file, ast, logger, handle, \
+    _trusted_fingerprint, _trust_fingerprint, _forget_fingerprint
 try:
     from bb.parse import metrics as _bb_metrics
+    if not _bb_metrics.ENABLED:
+        _bb_metrics = None
 except Exception:
     _bb_metrics = None
 
-__config_regexp__  = re.compile( r"""
-    ^
-    (?P<exp>export\s+)?
-    (?P<var>[a-zA-Z0-9\-_+.${}/~:]*?)
-    (\[(?P<flag>[a-zA-Z0-9\-_+.][a-zA-Z0-9\-_+.@/]*)\])?
-
-    (?P<whitespace>\s*) (
-        (?P<colon>:=) |
-        (?P<lazyques>\?\?=) |
-        (?P<ques>\?=) |
-        (?P<append>\+=) |
-        (?P<prepend>=\+) |
-        (?P<predot>=\.) |
-        (?P<postdot>\.=) |
-        =
-    ) (?P<whitespace2>\s*)
-
-    (?!'[^']*'[^']*'$)
-    (?!\"[^\"]*\"[^\"]*\"$)
-    (?P<apo>['\"])
-    (?P<value>.*)
-    (?P=apo)
-    $
-    """, re.X)
+# A value quoted with the same quote character as occurs once inside it (e.g.
+# A = 'it's') is not an assignment. That is checked after matching rather
+# than with lookaheads, which would rescan the whole value.
+__config_regexp__  = re.compile(r"(?P<exp>export\s+)?(?P<var>[a-zA-Z0-9\-_+.${}/~:]*?)(\[(?P<flag>[a-zA-Z0-9\-_+.][a-zA-Z0-9\-_+.@/]*)\])?(?P<whitespace>\s*)((?P<colon>:=)|(?P<lazyques>\?\?=)|(?P<ques>\?=)|(?P<append>\+=)|(?P<prepend>=\+)|(?P<predot>=\.)|(?P<postdot>\.=)|=)(?P<whitespace2>\s*)(?P<apo>['\"])(?P<value>.*)(?P=apo)")
+# Group numbers of the parts of an assignment, in the order ast.DataNode wants
+# them, so that they can be fetched with a single group() call
+_config_data_groups = tuple(__config_regexp__.groupindex[name] for name in ast.DataNode.fields)
+_config_whitespace_group = __config_regexp__.groupindex['whitespace']
+_config_whitespace2_group = __config_regexp__.groupindex['whitespace2']
 __include_regexp__ = re.compile( r"include\s+(.+)" )
 __require_regexp__ = re.compile( r"require\s+(.+)" )
 __includeall_regexp__ = re.compile( r"include_all\s+(.+)" )
@@ -54,6 +46,36 @@ __unset_flag_regexp__ = re.compile( r"unset\s+([a-zA-Z0-9\-_+.${}/~]+)\[([a-zA-Z
 __addpylib_regexp__      = re.compile(r"addpylib\s+(.+)\s+(.+)" )
 __addfragments_regexp__  = re.compile(r"addfragments\s+(.+)\s+(.+)\s+(.+)\s+(.+)" )
 
+# The statements other than assignments, in the order they are tried
+__directive_regexps__ = (
+    ("include", __include_regexp__),
+    ("require", __require_regexp__),
+    ("include_all", __includeall_regexp__),
+    ("export", __export_regexp__),
+    ("unset", __unset_regexp__),
+    ("unset_flag", __unset_flag_regexp__),
+    ("addpylib", __addpylib_regexp__),
+    ("addfragments", __addfragments_regexp__),
+)
+# All of the above as one alternation, so that a line costs a single match
+# whichever statement it is. Each alternative is a group named after the
+# statement, enclosing the groups of its own regexp.
+__directive_regexp__ = re.compile("|".join("(?P<%s>%s)" % (name, r.pattern) for name, r in __directive_regexps__))
+
+class _DirectiveMatch:
+    """
+    Wraps a match of __directive_regexp__ so that group(n) returns the n-th
+    group of the statement's own regexp, as the ast.handle*() functions expect.
+    """
+    __slots__ = ("m", "base")
+
+    def __init__(self, m):
+        self.m = m
+        self.base = m.lastindex
+
+    def group(self, n=0):
+        return self.m.group(self.base + n)
+
 def init(data):
     return
 
@@ -73,6 +95,16 @@ def include(parentfn, fns, lineno, data, error_out):
     for fn in fns.split():
         include_single_file(parentfn, fn, lineno, data, error_out)
 
+# LRU of resolved includes, (fn, dname, BBPATH) -> (abs_fn, attempts)
+_include_resolve_cache = OrderedDict()
+_include_resolve_max = 8192
+
+# Switches for the caches, read once rather than on every include
+_disable_include_lru = bool(os.environ.get('BB_OPT_DISABLE_INCLUDE_LRU'))
+_disable_include_index = bool(os.environ.get('BB_OPT_DISABLE_INCLUDE_INDEX'))
+_disable_conf_ast_cache = bool(os.environ.get('BB_OPT_DISABLE_CONF_AST_CACHE'))
+_disable_conf_ast_disk_cache = bool(os.environ.get('BB_OPT_DISABLE_CONF_AST_DISK_CACHE'))
+
 def include_single_file(parentfn, fn, lineno, data, error_out):
     """
     Helper function for include() which does not expand or split its parameters.
@@ -82,24 +114,14 @@ def include_single_file(parentfn, fn, lineno, data, error_out):
 
     if not os.path.isabs(fn):
         dname = os.path.dirname(parentfn)
-        bbpath = "%s:%s" % (dname, data.getVar("BBPATH"))
+        bbpath = data.getVar("BBPATH")
         # Resolve includes with a small LRU cache to avoid repeated scans
-        global _include_resolve_cache, _include_resolve_order, _include_resolve_max
-        try:
-            _include_resolve_cache
-        except NameError:
-            _include_resolve_cache = {}
-            _include_resolve_order = []
-            _include_resolve_max = 8192
-        key = (fn, dname, data.getVar("BBPATH"))
+        key = (fn, dname, bbpath)
         cached = None
-        if not os.environ.get('BB_OPT_DISABLE_INCLUDE_LRU'):
-            try:
-                _include_resolve_order.remove(key)
-                _include_resolve_order.append(key)
-                cached = _include_resolve_cache[key]
-            except (ValueError, KeyError):
-                pass
+        if not _disable_include_lru:
+            cached = _include_resolve_cache.get(key)
+            if cached is not None:
+                _include_resolve_cache.move_to_end(key)
         if cached is not None:
             abs_fn, attempts = cached
             if _bb_metrics:
@@ -113,9 +135,9 @@ def include_single_file(parentfn, fn, lineno, data, error_out):
                 except Exception:
                     _tok = None
             try:
-                use_index = ('/' not in fn) and (not os.environ.get('BB_OPT_DISABLE_INCLUDE_INDEX'))
+                use_index = ('/' not in fn) and (not _disable_include_index)
                 if use_index:
-                    abs_fn, attempts = _include_index_resolve(dname, data.getVar("BBPATH"), fn)
+                    abs_fn, attempts = _include_index_resolve(dname, bbpath, fn)
                     if _bb_metrics:
                         # Count index usage
                         if abs_fn:
@@ -123,7 +145,7 @@ def include_single_file(parentfn, fn, lineno, data, error_out):
                         else:
                             _bb_metrics.miss('include_index')
                 else:
-                    abs_fn, attempts = bb.utils.which(bbpath, fn, history=True)
+                    abs_fn, attempts = bb.utils.which("%s:%s" % (dname, bbpath), fn, history=True)
                     if _bb_metrics and ('/' not in fn):
                         _bb_metrics.miss('include_index')
             finally:
@@ -132,12 +154,10 @@ def include_single_file(parentfn, fn, lineno, data, error_out):
                         _bb_metrics.time_end('include', _tok)
                     except Exception:
                         pass
-            if not os.environ.get('BB_OPT_DISABLE_INCLUDE_LRU'):
+            if not _disable_include_lru:
                 _include_resolve_cache[key] = (abs_fn, tuple(attempts))
-                _include_resolve_order.append(key)
-                if len(_include_resolve_order) > _include_resolve_max:
-                    old = _include_resolve_order.pop(0)
-                    _include_resolve_cache.pop(old, None)
+                if len(_include_resolve_cache) > _include_resolve_max:
+                    _include_resolve_cache.popitem(last=False)
                     if _bb_metrics:
                         _bb_metrics.evict('include')
             if _bb_metrics:
@@ -172,67 +192,93 @@ def include_single_file(parentfn, fn, lineno, data, error_out):
 # parsing. This turns out to be a hard problem to solve any other way.
 confFilters = []
 
-def handle(fn, data, include, baseconfig=False):
-    init(data)
+# Cache parsed statements of .conf files (AST), keyed by (abs_fn, baseconfig),
+# as ((mtime_ns, size), statements, warnings). warnings holds the (level,
+# message) pairs logged while parsing, which are logged again whenever the
+# cached statements are used, as they would be by a reparse.
+_conf_statements_cache = {}
 
-    if include == 0:
-        oldfile = None
-    else:
-        oldfile = data.getVar('FILE', False)
+# Parsed statements are also kept on disk under TMPDIR so that they survive
+# between invocations. Bump the version whenever the AST nodes change.
+__conf_ast_cache_version__ = "3"
+_conf_ast_cache_header = ("CONFAST:%s:%s\n" % (__conf_ast_cache_version__, bb.__version__)).encode()
 
-    abs_fn = resolve_file(fn, data)
-    with open(abs_fn, 'r') as f:
-
-        statements = ast.StatementGroup()
-        lineno = 0
-        for lineno, origline in enumerate(f, start=1):
-            w = origline.strip()
-            if not w:
-                continue
-            s = origline.rstrip()
-            origlineno = lineno
-            while s[-1] == '\\':
-                line = f.readline()
-                if not line:
-                    break
-                origline += line
-                s2 = line.rstrip()
-                lineno = lineno + 1
-                if (not s2 or (s2 and s2[0] != "#")) and s[0] == "#":
-                    bb.fatal("There is a confusing multiline, partially commented expression starting on line %s of file %s:\n%s\nPlease clarify whether this is all a comment or should be parsed." % (origlineno, fn, origline))
-
-                s = s[:-1] + s2
-            if s and s[0] == '#':
-                continue
-            feeder(lineno, s, abs_fn, statements, baseconfig=baseconfig)
+def _conf_ast_cache_file(cachedir, abs_fn, baseconfig):
+    # One file per conf file, replaced when the conf file changes
+    h = hashlib.blake2b(("%s:%s" % (abs_fn, bool(baseconfig))).encode(), digest_size=16).hexdigest()
+    return os.path.join(cachedir, h + ".pkl")
 
-    # DONE WITH PARSING... time to evaluate
-    data.setVar('FILE', abs_fn)
-    statements.eval(data)
-    if oldfile:
-        data.setVar('FILE', oldfile)
+def _load_conf_ast(cachefile, stamp):
+    """Return the (stamp, statements, warnings) entry stored in cachefile
+    if it is still valid for stamp, otherwise None"""
+    try:
+        with open(cachefile, "rb") as f:
+            if f.read(len(_conf_ast_cache_header)) != _conf_ast_cache_header:
+                return None
+            entry = pickle.load(f)
+    except Exception:
+        # Missing, truncated or stale entries just mean a reparse
+        return None
+    if not isinstance(entry, tuple) or len(entry) != 3 or entry[0] != stamp:
+        return None
+    if not isinstance(entry[1], ast.StatementGroup):
+        return None
+    return entry
+
+def _save_conf_ast(cachefile, entry):
+    tmpfile = None
+    try:
+        cachedir = os.path.dirname(cachefile)
+        bb.utils.mkdirhier(cachedir)
+        fd, tmpfile = bb.utils.mkstemp(dir=cachedir, prefix="confast.")
+        with os.fdopen(fd, "wb") as f:
+            f.write(_conf_ast_cache_header)
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, cachefile)
+    except Exception:
+        # The cache is an optimisation only, never fail the parse over it
+        if tmpfile:
+            try:
+                os.unlink(tmpfile)
+            except OSError:
+                pass
 
-    for f in confFilters:
-        f(fn, data)
+class _WarningRecorder(logging.Handler):
+    """Records the warnings and errors logged while it is attached"""
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.records = []
 
-    return data
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
 
-# Cache parsed statements of .conf files (AST), keyed by (abs_fn, baseconfig)
-_conf_statements_cache = {}
+# Directory of the on-disk conf AST cache, set by the cooker once the base
+# configuration (and so the final TMPDIR) is known, see set_conf_ast_cachedir()
+_conf_ast_cachedir = None
 
 # Include index: basename -> absolute path per (dname, BBPATH) with directory fingerprinting
-_include_index_cache = {}
-_include_index_order = []
+_include_index_cache = OrderedDict()
 _include_index_max = 256
 
+# Directory → ((mtime_ns, ino), {name: path}), shared by all the include
+# indexes so that each directory is only scanned once whatever the includer
+_dir_listing_cache = OrderedDict()
+_dir_listing_max = 1024
+
+# BBPATH value → its non-empty entries
+_bbpath_split_cache = {}
+
+def _split_bbpath(bbpath):
+    dirs = _bbpath_split_cache.get(bbpath)
+    if dirs is None:
+        dirs = _bbpath_split_cache[bbpath] = tuple(p for p in bbpath.split(':') if p)
+    return dirs
+
 def _include_search_dirs(dname, bbpath):
-    dirs = []
     # Prepend the directory of the including file
+    dirs = _split_bbpath(bbpath or '')
     if dname:
-        dirs.append(dname)
-    for p in (bbpath or '').split(':'):
-        if p:
-            dirs.append(p)
+        return (dname,) + dirs
     return dirs
 
 def _dirs_fingerprint(dirs):
@@ -245,48 +291,61 @@ def _dirs_fingerprint(dirs):
             fp.append((d, 0, 0))
     return tuple(fp)
 
+def _dir_listing(d, dfp):
+    """Return {name: path} for the files in directory d, only scanning it
+    again when its (mtime_ns, ino) fingerprint dfp has changed"""
+    cached = _dir_listing_cache.get(d)
+    if cached is not None and cached[0] == dfp:
+        _dir_listing_cache.move_to_end(d)
+        return cached[1]
+    listing = {}
+    try:
+        with os.scandir(d) as it:
+            for de in it:
+                # Only index regular files and symlinks to files
+                try:
+                    isfile = de.is_file(follow_symlinks=True)
+                except OSError:
+                    isfile = False
+                if isfile:
+                    listing[de.name] = os.path.join(d, de.name)
+    except OSError:
+        pass
+    _dir_listing_cache[d] = (dfp, listing)
+    _dir_listing_cache.move_to_end(d)
+    if len(_dir_listing_cache) > _dir_listing_max:
+        _dir_listing_cache.popitem(last=False)
+    return listing
+
 def _build_include_index(dname, bbpath):
-    dirs = _include_search_dirs(dname, bbpath)
+    # Fingerprint before listing so that a change racing with the scan is
+    # picked up next time
+    fp = _dirs_fingerprint(_include_search_dirs(dname, bbpath))
     mapping = {}
-    for d in dirs:
-        try:
-            with os.scandir(d) as it:
-                for de in it:
-                    # Only index regular files and symlinks to files
-                    try:
-                        isfile = de.is_file(follow_symlinks=True)
-                    except OSError:
-                        isfile = False
-                    if not isfile:
-                        continue
-                    name = de.name
-                    if name not in mapping:
-                        mapping[name] = os.path.join(d, name)
-        except OSError:
-            continue
-    return _dirs_fingerprint(dirs), mapping
+    # The first directory containing a name wins
+    for d, mtime, ino in reversed(fp):
+        if ino:
+            mapping.update(_dir_listing(d, (mtime, ino)))
+    return fp, mapping
 
 def _get_include_index(dname, bbpath):
     key = (dname or '', bbpath or '')
     cached = _include_index_cache.get(key)
-    dirs = _include_search_dirs(dname, bbpath)
-    fp = _dirs_fingerprint(dirs)
+    fpkey = ("include",) + key
+    fp = _trusted_fingerprint(fpkey, _dirs_fingerprint, _include_search_dirs(dname, bbpath))
     if cached is not None:
         cfp, cmap = cached
         if cfp == fp:
-            try:
-                _include_index_order.remove(key)
-            except ValueError:
-                pass
-            _include_index_order.append(key)
+            _include_index_cache.move_to_end(key)
             return cmap
     # (Re)build
     cfp, cmap = _build_include_index(dname, bbpath)
+    _trust_fingerprint(fpkey, cfp)
     _include_index_cache[key] = (cfp, cmap)
-    _include_index_order.append(key)
-    if len(_include_index_order) > _include_index_max:
-        old = _include_index_order.pop(0)
-        _include_index_cache.pop(old, None)
+    _include_index_cache.move_to_end(key)
+    if len(_include_index_cache) > _include_index_max:
+        old, _ = _include_index_cache.popitem(last=False)
+        _forget_fingerprint(("include",) + old)
     return cmap
 
 def _include_index_resolve(dname, bbpath, filename):
@@ -295,48 +354,111 @@ def _include_index_resolve(dname, bbpath, filename):
     """
     cmap = _get_include_index(dname, bbpath)
     resolved = cmap.get(filename)
-    attempts = []
-    for d in _include_search_dirs(dname, bbpath):
-        attempts.append(os.path.abspath(os.path.join(d, filename)))
-    return resolved, tuple(attempts)
+    # Like the history from bb.utils.which(), attempts are plain joins and
+    # stop at the file found. Files after it can't change the result.
+    attempts = tuple(os.path.join(d, filename) for d in _include_search_dirs(dname, bbpath))
+    if resolved:
+        attempts = attempts[:attempts.index(resolved) + 1]
+    return resolved, attempts
+
+def _logical_lines(text, fn):
+    """
+    Yield (lineno, line) for each statement line in the text of file fn,
+    with backslash continuations joined and trailing whitespace stripped.
+    Blank and comment lines are skipped. lineno is the number of the last
+    physical line of the statement.
+    """
+    lines = text.split('\n')
+    # A trailing newline doesn't start another line
+    if not lines[-1]:
+        lines.pop()
+    if '\\' not in text:
+        # One scan of the whole text shows there are no continuations, so
+        # each line stands on its own
+        for i, line in enumerate(lines, 1):
+            s = line.rstrip()
+            if s and not s.startswith('#'):
+                yield i, s
+        return
+    nlines = len(lines)
+    i = 0
+    while i < nlines:
+        origline = lines[i]
+        i += 1
+        s = origline.rstrip()
+        if not s:
+            continue
+        origlineno = i
+        while s.endswith('\\') and i < nlines:
+            line = lines[i]
+            i += 1
+            origline += '\n' + line
+            s2 = line.rstrip()
+            if s.startswith('#') and not s2.startswith('#'):
+                bb.fatal("There is a confusing multiline, partially commented expression starting on line %s of file %s:\n%s\nPlease clarify whether this is all a comment or should be parsed." % (origlineno, fn, origline))
+            s = s[:-1] + s2
+        if s.startswith('#'):
+            continue
+        yield i, s
+
+def _parse_conf_lines(abs_fn, baseconfig):
+    """Parse the file abs_fn into a StatementGroup"""
+    # Decoding the whole file at once is much cheaper than text mode I/O
+    with open(abs_fn, 'rb') as f:
+        text = f.read().decode('utf-8')
+    # Keep the universal newline handling text mode would have done
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    statements = ast.StatementGroup()
+    for lineno, s in _logical_lines(text, abs_fn):
+        feeder(lineno, s, abs_fn, statements, baseconfig=baseconfig)
+    return statements
+
+def _use_cached(entry):
+    for level, msg in entry[2]:
+        logger.log(level, msg)
+    return entry[1]
 
-def _get_conf_statements(abs_fn, baseconfig):
+def _get_conf_statements(abs_fn, baseconfig, cachedir=None):
     key = (abs_fn, bool(baseconfig))
-    st = None if os.environ.get('BB_OPT_DISABLE_CONF_AST_CACHE') else _conf_statements_cache.get(key)
-    if st is not None:
+    # Validate against the file's mtime and size so that a long running
+    # server picks up edits
+    st = os.stat(abs_fn)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = None if _disable_conf_ast_cache else _conf_statements_cache.get(key)
+    if cached is not None and cached[0] == stamp:
         if _bb_metrics:
             _bb_metrics.hit('conf_ast')
-        return st
+        return _use_cached(cached)
+    cachefile = None
+    if cachedir and not _disable_conf_ast_disk_cache:
+        cachefile = _conf_ast_cache_file(cachedir, abs_fn, baseconfig)
+        entry = _load_conf_ast(cachefile, stamp)
+        if entry is not None:
+            if _bb_metrics:
+                _bb_metrics.hit('conf_ast_disk')
+            if not _disable_conf_ast_cache:
+                _conf_statements_cache[key] = entry
+            return _use_cached(entry)
+        if _bb_metrics:
+            _bb_metrics.miss('conf_ast_disk')
     _tok = None
     if _bb_metrics:
         try:
             _tok = _bb_metrics.time_start('conf_ast_parse')
         except Exception:
             _tok = None
-    with open(abs_fn, 'r') as f:
-        statements = ast.StatementGroup()
-        lineno = 0
-        for lineno, origline in enumerate(f, start=1):
-            w = origline.strip()
-            if not w:
-                continue
-            s = origline.rstrip()
-            origlineno = lineno
-            while s[-1] == '\\':
-                line = f.readline()
-                if not line:
-                    break
-                origline += line
-                s2 = line.rstrip()
-                lineno = lineno + 1
-                if (not s2 or (s2 and s2[0] != "#")) and s[0] == "#":
-                    bb.fatal("There is a confusing multiline, partially commented expression starting on line %s of file %s:\n%s\nPlease clarify whether this is all a comment or should be parsed." % (origlineno, abs_fn, origline))
-                s = s[:-1] + s2
-            if s and s[0] == '#':
-                continue
-            feeder(lineno, s, abs_fn, statements, baseconfig=baseconfig)
-    if not os.environ.get('BB_OPT_DISABLE_CONF_AST_CACHE'):
-        _conf_statements_cache[key] = statements
+    recorder = _WarningRecorder()
+    logger.addHandler(recorder)
+    try:
+        statements = _parse_conf_lines(abs_fn, baseconfig)
+    finally:
+        logger.removeHandler(recorder)
+    entry = (stamp, statements, tuple(recorder.records))
+    if cachefile:
+        _save_conf_ast(cachefile, entry)
+    if not _disable_conf_ast_cache:
+        _conf_statements_cache[key] = entry
     if _bb_metrics:
         _bb_metrics.miss('conf_ast')
     if _bb_metrics and _tok:
@@ -346,15 +468,22 @@ def _get_conf_statements(abs_fn, baseconfig):
             pass
     return statements
 
-# Override handle() with a version that reuses cached AST for .conf files
+def set_conf_ast_cachedir(cachedir):
+    """
+    Store parsed conf files below cachedir, or only keep them in memory if
+    cachedir is None. TMPDIR may still be changed by any conf file until the
+    base configuration is complete, so callers must only set this afterwards.
+    """
+    global _conf_ast_cachedir
+    if _disable_conf_ast_disk_cache:
+        cachedir = None
+    _conf_ast_cachedir = cachedir
+
 def handle(fn, data, include, baseconfig=False):
     init(data)
     # Set metrics output path from TMPDIR so metrics can write without extra config
-    try:
-        from bb.parse import metrics as _m
-        _m.set_tmpdir(data.getVar('TMPDIR'))
-    except Exception:
-        pass
+    if _bb_metrics:
+        _bb_metrics.set_tmpdir(data.getVar('TMPDIR'))
 
     if include == 0:
         oldfile = None
@@ -362,7 +491,7 @@ def handle(fn, data, include, baseconfig=False):
         oldfile = data.getVar('FILE', False)
 
     abs_fn = resolve_file(fn, data)
-    statements = _get_conf_statements(abs_fn, baseconfig)
+    statements = _get_conf_statements(abs_fn, baseconfig, _conf_ast_cachedir)
 
     # DONE WITH PARSING... time to evaluate
     data.setVar('FILE', abs_fn)
@@ -381,75 +510,67 @@ def handle(fn, data, include, baseconfig=False):
     if oldfile:
         data.setVar('FILE', oldfile)
 
-    for f in confFilters:
-        f(fn, data)
+    if confFilters:
+        for f in confFilters:
+            f(fn, data)
 
-    try:
-        return data
-    finally:
-        try:
-            if include == 0:
-                from bb.parse import metrics as _m
-                _m.flush('confhandler')
-        except Exception:
-            pass
+    if include == 0 and _bb_metrics:
+        _bb_metrics.flush('confhandler')
+    return data
 
 # baseconfig is set for the bblayers/layer.conf cookerdata config parsing
 # The function is also used by BBHandler, conffile would be False
 def feeder(lineno, s, fn, statements, baseconfig=False, conffile=True):
-    m = __config_regexp__.match(s)
+    # Every assignment operator contains '=' and the value must be quoted, so
+    # lines without both can skip the (expensive) assignment regexp
+    if '=' in s and ('"' in s or "'" in s):
+        m = __config_regexp__.fullmatch(s)
+        if m and m.group('value').count(m.group('apo')) == 1:
+            m = None
+    else:
+        m = None
     if m:
-        groupd = m.groupdict()
-        if groupd['var'] == "":
+        groups = m.group(*_config_data_groups)
+        if groups[1] == "":
             raise ParseError("Empty variable name in assignment: '%s'" % s, fn, lineno);
-        if not groupd['whitespace'] or not groupd['whitespace2']:
+        if not m.group(_config_whitespace_group) or not m.group(_config_whitespace2_group):
             logger.warning("%s:%s has a lack of whitespace around the assignment: '%s'" % (fn, lineno, s))
-        ast.handleData(statements, fn, lineno, groupd)
-        return
-
-    m = __include_regexp__.match(s)
-    if m:
-        ast.handleInclude(statements, fn, lineno, m, False)
-        return
-
-    m = __require_regexp__.match(s)
-    if m:
-        ast.handleInclude(statements, fn, lineno, m, True)
-        return
-
-    m = __includeall_regexp__.match(s)
-    if m:
-        ast.handleIncludeAll(statements, fn, lineno, m)
+        ast.handleData(statements, fn, lineno, groups)
         return
 
-    m = __export_regexp__.match(s)
+    m = __directive_regexp__.match(s)
     if m:
-        ast.handleExport(statements, fn, lineno, m)
-        return
-
-    m = __unset_regexp__.match(s)
-    if m:
-        ast.handleUnset(statements, fn, lineno, m)
-        return
-
-    m = __unset_flag_regexp__.match(s)
-    if m:
-        ast.handleUnsetFlag(statements, fn, lineno, m)
-        return
-
-    m = __addpylib_regexp__.match(s)
-    if baseconfig and conffile and m:
-        ast.handlePyLib(statements, fn, lineno, m)
-        return
-
-    m = __addfragments_regexp__.match(s)
-    if m:
-        ast.handleAddFragments(statements, fn, lineno, m)
-        return
+        kind = m.lastgroup
+        m = _DirectiveMatch(m)
+        if kind == "include":
+            ast.handleInclude(statements, fn, lineno, m, False)
+            return
+        if kind == "require":
+            ast.handleInclude(statements, fn, lineno, m, True)
+            return
+        if kind == "include_all":
+            ast.handleIncludeAll(statements, fn, lineno, m)
+            return
+        if kind == "export":
+            ast.handleExport(statements, fn, lineno, m)
+            return
+        if kind == "unset":
+            ast.handleUnset(statements, fn, lineno, m)
+            return
+        if kind == "unset_flag":
+            ast.handleUnsetFlag(statements, fn, lineno, m)
+            return
+        if kind == "addpylib":
+            if baseconfig and conffile:
+                ast.handlePyLib(statements, fn, lineno, m)
+                return
+        elif kind == "addfragments":
+            ast.handleAddFragments(statements, fn, lineno, m)
+            return
 
     raise ParseError("unparsed line: '%s'" % s, fn, lineno);
 
 # Add us to the handlers list
-from bb.parse import handlers
-handlers.append({'supports': supports, 'handle': handle, 'init': init})
-del handlers
+from bb.parse import register_handler
+register_handler((".conf",), {'supports': supports, 'handle': handle, 'init': init})
+del register_handler
@@ -7,10 +7,12 @@
 #
 
 import unittest
+import unittest.mock
 import tempfile
 import logging
 import bb
 import os
+import sys
 
 logger = logging.getLogger('BitBake.TestParse')
 
@@ -444,6 +446,174 @@ include \\
                 in_file.flush()
             bb.parse.handle(recipename_closed, bb.data.createCopy(self.d))
 
+    def test_resolve_file_negative_cache(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            os.makedirs(tempdir + "/a")
+            os.makedirs(tempdir + "/b")
+            self.d.setVar("BBPATH", tempdir + "/a:" + tempdir + "/b")
+            attempts = [tempdir + "/a/missing.conf", tempdir + "/b/missing.conf"]
+            # The second lookup is answered from the cache but must still
+            # record every attempted path as a dependency
+            for _ in range(2):
+                d = bb.data.createCopy(self.d)
+                with self.assertRaises(IOError):
+                    bb.parse.resolve_file("missing.conf", d)
+                self.assertEqual([f for f, _ in d.getVar("__depends", False)], attempts)
+
+            with open(tempdir + "/b/missing.conf", "w") as f:
+                f.write('A = "1"\n')
+            bb.parse.clear_cache()
+            self.assertEqual(bb.parse.resolve_file("missing.conf", self.d), tempdir + "/b/missing.conf")
+
+    def test_vars_from_file(self):
+        self.assertEqual(bb.parse.vars_from_file("/a/foo_1.0_r0.bb", self.d), ["foo", "1.0", "r0"])
+        self.assertEqual(bb.parse.vars_from_file("/b/foo_1.0.bbappend", self.d), ["foo", "1.0", None])
+        self.assertEqual(bb.parse.vars_from_file("/a/foo.conf", self.d), (None, None, None))
+        # Names which can't be split must fail every time, not just the first
+        for _ in range(2):
+            with self.assertRaises(bb.parse.ParseError):
+                bb.parse.vars_from_file("/a/foo_1.0_r0_extra.bb", self.d)
+
+    def rewrite(self, fn, content):
+        # Write content and move the mtime on, as quick successive writes
+        # can otherwise share a timestamp
+        st = os.stat(fn)
+        with open(fn, "w") as f:
+            f.write(content)
+        os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+    def test_parse_recipe_edited(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            recipename = tempdir + "/recipe.bb"
+            with open(recipename, "w") as f:
+                f.write('A = "1"\n')
+            os.chdir(tempdir)
+            d = bb.parse.handle(recipename, bb.data.createCopy(self.d))['']
+            self.assertEqual(d.getVar("A"), "1")
+            # Unchanged files reuse the parsed statements
+            statements = bb.parse.BBHandler.get_statements(recipename, recipename, "recipe")
+            self.assertIs(bb.parse.BBHandler.get_statements(recipename, recipename, "recipe"), statements)
+
+            # Edits are picked up, whether or not the size changes
+            self.rewrite(recipename, 'A = "22"\n')
+            d = bb.parse.handle(recipename, bb.data.createCopy(self.d))['']
+            self.assertEqual(d.getVar("A"), "22")
+            self.rewrite(recipename, 'A = "33"\n')
+            d = bb.parse.handle(recipename, bb.data.createCopy(self.d))['']
+            self.assertEqual(d.getVar("A"), "33")
+
+    def test_parse_conf_edited(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            confname = tempdir + "/test.conf"
+            with open(confname, "w") as f:
+                f.write('A = "1"\n')
+            d = bb.parse.handle(confname, bb.data.createCopy(self.d))
+            self.assertEqual(d.getVar("A"), "1")
+            # Unchanged files reuse the parsed statements
+            if not bb.parse.ConfHandler._disable_conf_ast_cache:
+                statements = bb.parse.ConfHandler._get_conf_statements(confname, False)
+                self.assertIs(bb.parse.ConfHandler._get_conf_statements(confname, False), statements)
+
+            # Edits are picked up, whether or not the size changes
+            self.rewrite(confname, 'A = "22"\n')
+            d = bb.parse.handle(confname, bb.data.createCopy(self.d))
+            self.assertEqual(d.getVar("A"), "22")
+            self.rewrite(confname, 'A = "33"\n')
+            d = bb.parse.handle(confname, bb.data.createCopy(self.d))
+            self.assertEqual(d.getVar("A"), "33")
+
+    @unittest.skipIf(bb.parse.ConfHandler._disable_conf_ast_disk_cache, "conf AST disk cache disabled")
+    def test_parse_conf_disk_cache(self):
+        ConfHandler = bb.parse.ConfHandler
+        with tempfile.TemporaryDirectory() as tempdir:
+            confname = tempdir + "/test.conf"
+            with open(confname, "w") as f:
+                f.write('A="1"\nB = "2"\n')
+            cachedir = tempdir + "/tmp/cache/conf_ast"
+            cachefile = ConfHandler._conf_ast_cache_file(cachedir, confname, False)
+
+            def parse():
+                # Start each parse like a new invocation would
+                ConfHandler._conf_statements_cache.clear()
+                with self.assertLogs("BitBake.Parsing", level="WARNING") as logs:
+                    d = bb.parse.handle(confname, bb.data.createCopy(self.d))
+                self.assertIn("lack of whitespace", logs.output[0])
+                return d
+
+            # Nothing is written to disk until the cooker provides a cache
+            # directory
+            parse()
+            self.assertFalse(os.path.exists(cachedir))
+
+            ConfHandler.set_conf_ast_cachedir(cachedir)
+            self.addCleanup(ConfHandler.set_conf_ast_cachedir, None)
+            d = parse()
+            self.assertEqual(d.getVar("A"), "1")
+            self.assertTrue(os.path.exists(cachefile))
+
+            # A valid cache file is used instead of parsing, and the parse
+            # warnings are repeated
+            with unittest.mock.patch.object(ConfHandler, "_parse_conf_lines", side_effect=AssertionError):
+                d = parse()
+            self.assertEqual(d.getVar("A"), "1")
+            self.assertEqual(d.getVar("B"), "2")
+
+            # A file with a stale header is ignored and rewritten
+            with open(cachefile, "r+b") as f:
+                f.write(b"CONFAST:0")
+            d = parse()
+            self.assertEqual(d.getVar("A"), "1")
+            with open(cachefile, "rb") as f:
+                self.assertTrue(f.read().startswith(ConfHandler._conf_ast_cache_header))
+
+            # Edits replace the cache file rather than adding another one
+            self.rewrite(confname, 'A="22"\nB = "2"\n')
+            d = parse()
+            self.assertEqual(d.getVar("A"), "22")
+            self.assertEqual(os.listdir(cachedir), [os.path.basename(cachefile)])
+
+    @unittest.skipIf(bb.parse.ConfHandler._disable_conf_ast_disk_cache, "conf AST disk cache disabled")
+    def test_parse_conf_disk_cache_interned(self):
+        ConfHandler = bb.parse.ConfHandler
+        with tempfile.TemporaryDirectory() as tempdir:
+            confname = tempdir + "/test.conf"
+            with open(confname, "w") as f:
+                f.write('INTERNED_VAR[interned_flag] = "1"\n')
+            cachedir = tempdir + "/cache"
+            ConfHandler.set_conf_ast_cachedir(cachedir)
+            self.addCleanup(ConfHandler.set_conf_ast_cachedir, None)
+            ConfHandler._conf_statements_cache.clear()
+            bb.parse.handle(confname, bb.data.createCopy(self.d))
+
+            cachefile = ConfHandler._conf_ast_cache_file(cachedir, confname, False)
+            st = os.stat(confname)
+            entry = ConfHandler._load_conf_ast(cachefile, (st.st_mtime_ns, st.st_size))
+            node = entry[1][0]
+            self.assertIsInstance(node, bb.parse.ast.DataNode)
+            self.assertEqual(node.groups[1:3], ("INTERNED_VAR", "interned_flag"))
+            self.assertIs(sys.intern(node.groups[1]), node.groups[1])
+            self.assertIs(sys.intern(node.groups[2]), node.groups[2])
+
+    continuation_conf = """A = "a \\
+  b \\
+  c"
+B = "x"
+
+# a comment \\
+# continued
+C = "y"
+"""
+    def test_parse_conf_continuation_lineno(self):
+        f = self.parsehelper(self.continuation_conf, suffix=".conf")
+        self.d.enableTracking()
+        d = bb.parse.handle(f.name, self.d)
+        self.assertEqual(d.getVar("A"), "a   b   c")
+        # A continued statement is reported at its last physical line and
+        # the lines after it keep their own numbers
+        self.assertEqual([h['line'] for h in d.varhistory.variable("A")], [3])
+        self.assertEqual([h['line'] for h in d.varhistory.variable("B")], [4])
+        self.assertEqual([h['line'] for h in d.varhistory.variable("C")], [8])
+
     special_character_assignment = """
 A+="a"
 A+ = "b"
@@ -1167,9 +1167,10 @@ def break_hardlinks(src, sstat = None):
         return True
     return copyfile(src, src, sstat=sstat)
 
-_which_cache = {}
-_which_cache_order = []
+# which() results, kept in LRU order (oldest first)
+_which_cache = collections.OrderedDict()
 _which_cache_max = 8192
+_disable_which_cache = bool(os.environ.get('BB_OPT_DISABLE_WHICH_CACHE'))
 _bb_metrics = None
 
 def _get_metrics():
@@ -1179,14 +1180,16 @@ def _get_metrics():
         try:
             import importlib
             _bb_metrics = importlib.import_module('bb.parse.metrics')
+            if not _bb_metrics.ENABLED:
+                _bb_metrics = False
         except Exception:
             _bb_metrics = False
     return _bb_metrics if _bb_metrics not in (None, False) else None
 
 # Per-directory entry index to reduce filesystem stats when scanning paths
-_dir_index = {}
-_dir_index_order = []
+_dir_index = collections.OrderedDict()
 _dir_index_max = 1024
+_disable_dir_index = bool(os.environ.get('BB_OPT_DISABLE_DIR_INDEX'))
 
 def _dir_entries(path):
     """Return cached set of basenames in directory, updating on mtime/inode change.
@@ -1202,12 +1205,8 @@ def _dir_entries(path):
         if ent is not None:
             (mtime, ino, names) = ent
             if mtime == st.st_mtime_ns and ino == st.st_ino:
-                # Refresh simple LRU
-                try:
-                    _dir_index_order.remove(key)
-                except ValueError:
-                    pass
-                _dir_index_order.append(key)
+                # Refresh LRU
+                _dir_index.move_to_end(key)
                 return names
     except Exception:
         pass
@@ -1218,25 +1217,23 @@ def _dir_entries(path):
             for de in it:
                 names.add(de.name)
         _dir_index[key] = (st.st_mtime_ns, st.st_ino, names)
-        _dir_index_order.append(key)
-        if len(_dir_index_order) > _dir_index_max:
-            old = _dir_index_order.pop(0)
-            _dir_index.pop(old, None)
+        _dir_index.move_to_end(key)
+        if len(_dir_index) > _dir_index_max:
+            _dir_index.popitem(last=False)
         return names
     except Exception:
         return None
 
 def _which_cache_get(key):
     try:
-        # Keep a simple LRU order; move key to tail on hit
-        _which_cache_order.remove(key)
-        _which_cache_order.append(key)
+        # Keep LRU order; move key to tail on hit
         val = _which_cache[key]
+        _which_cache.move_to_end(key)
         m = _get_metrics()
         if m:
             m.hit('which')
         return val
-    except (ValueError, KeyError):
+    except KeyError:
         m = _get_metrics()
         if m:
             m.miss('which')
@@ -1244,14 +1241,16 @@ def _which_cache_get(key):
 
 def _which_cache_put(key, value):
     _which_cache[key] = value
-    _which_cache_order.append(key)
-    if len(_which_cache_order) > _which_cache_max:
-        old = _which_cache_order.pop(0)
-        _which_cache.pop(old, None)
+    _which_cache.move_to_end(key)
+    if len(_which_cache) > _which_cache_max:
+        _which_cache.popitem(last=False)
         m = _get_metrics()
         if m:
             m.evict('which')
 
+def _which_cache_clear():
+    _which_cache.clear()
+
 def which(path, item, direction = 0, history = False, executable=False):
     """
     Locate ``item`` in the list of paths ``path`` (colon separated string like
@@ -1288,7 +1287,7 @@ def which(path, item, direction = 0, history = False, executable=False):
             is_candidate = lambda p: os.path.exists(p)
 
         # Cache by inputs that affect search outcome (optional)
-        disable_cache = os.environ.get('BB_OPT_DISABLE_WHICH_CACHE')
+        disable_cache = _disable_which_cache
         cachekey = (path or "", item, 1 if direction else 0, 1 if executable else 0)
         cached = None if disable_cache else _which_cache_get(cachekey)
         if cached is not None:
@@ -1308,8 +1307,7 @@ def which(path, item, direction = 0, history = False, executable=False):
             # Fast-path filter: if the parent directory listing doesn't contain the basename, skip costly stat()
             d, base = os.path.split(next)
             if base:
-                disable_dir_index = os.environ.get('BB_OPT_DISABLE_DIR_INDEX')
-                names = None if disable_dir_index else _dir_entries(d)
+                names = None if _disable_dir_index else _dir_entries(d)
                 if names is not None:
                     if base not in names:
                         # Directory index filtered out a non-existent candidate